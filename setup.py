@@ -18,9 +18,9 @@ import os
 from setuptools import setup, find_packages
 
 
-INSTALL_REQUIRES = ["pyte >= 0.8.1", "ansi >= 0.3.6"]
+INSTALL_REQUIRES = ["pyte >= 0.8.1"]
 
-TESTS_REQUIRE = []
+TESTS_REQUIRE = ["pytest"]
 
 VERSION = "0.0.1"
 
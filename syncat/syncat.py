@@ -27,17 +27,19 @@ output all characters to the user's actual terminal.
 
 __version__ = "0.0.1"
 
+import io
 import os
 import sys
 import pty
 import pyte
-import types
 import errno
+import stat
 import fcntl
+import shutil
+import signal
 import struct
 import termios
-
-from ansi.color import (fg, bg, fx)
+import selectors
 
 # This can't be more than 65535, because the related field
 # in the ioctl to set the PTY window size in the kernel is a short int.
@@ -49,6 +51,28 @@ from ansi.color import (fg, bg, fx)
 #       This definitely needs a test.
 MAX_LINES = 1000
 
+# Vim redraws, and pyte emulates, every line of the window, even past the end
+# of the file, so don't make the window any taller than the input needs,
+# see estimate_screen_lines(). Leave some room for any lines we may have
+# underestimated, and for Vim's own command line.
+SCREEN_LINES_MARGIN = 20
+
+# Leave room for any columns Vim may reserve on the left of the window,
+# e.g., for line numbers, signs, or folds, when estimating wrapped lines.
+SCREEN_GUTTER_COLUMNS = 10
+
+# How many bytes to retrieve from the PTY in a single read().
+# Vim emits tens to hundreds of KiB when redrawing a large window,
+# so read in large chunks to minimize syscalls and calls into pyte.
+READ_SIZE = 65536
+
+# When to highlight the input, similarly to GNU ls' `--color`:
+# "always", "never", or "auto", i.e., only when stdout is a terminal.
+# Defaults to "always", so `syncat` works as an input preprocessor for
+# `less -R`, where its output is a pipe.
+SYNCAT_COLOR_DEFAULT = "always"
+SYNCAT_COLOR_CHOICES = ("always", "auto", "never")
+
 
 def pty_set_winsize(fd, ws_row, ws_col, ws_xpixel=0, ws_ypixel=0):
     """Set the PTY window size in the kernel.
@@ -81,9 +105,11 @@ def terminal_set_size(fd, rows, cols):
         https://stackoverflow.com/questions/6418678/resize-the-terminal-with-python
 
     """
-    seq = ("\x1b[8;%d;%dt" % (rows, cols)).encode("ascii")
-    if os.write(fd, seq) != len(seq):
-        msg = "InternalError: write to fd %d returned unexpected %d != %d"
+    seq = b"\x1b[8;%d;%dt" % (rows, cols)
+    written = os.write(fd, seq)
+    if written != len(seq):
+        msg = ("InternalError: write to fd %d returned unexpected %d != %d" %
+               (fd, written, len(seq)))
         raise RuntimeError(msg)
 
 
@@ -121,7 +147,7 @@ def construct_vim_cmdline(ifname):
     # Move to the last line, then trigger the "set window title" ANSI escape
     # sequence, and use the window title as a side channel to pass information
     # [the current line] to Syncat.
-    # Also see how we monkey patch the relevant method in the Screen object
+    # Also see how SyncatScreen overrides the relevant method of pyte's Screen
     # to run our own callback whenever Vim attempts to set the window title.
     # TODO: Turn this into a way to work around the 1000-line maximum
     #       window size, see comment at MAX_LINES, above.
@@ -145,50 +171,128 @@ def _dump_screen(screen):
     useful for debugging.
 
     """
-    print("\n".join("*" + row + "*" for row in screen.display))
+    print("\n".join(["*" + row + "*" for row in screen.display]))
+
+
+# ANSI sequences for the attributes we support. These are plain SGR
+# sequences, we produce them directly instead of going through a library.
+_FX_RESET = "\x1b[0m"
+_FX_BOLD = "\x1b[1m"
+_FX_ITALIC = "\x1b[3m"
+_FX_UNDERLINE = "\x1b[4m"
+_FX_CROSSED_OUT = "\x1b[9m"
+_FX_INVERSE = "\x1b[7m"
+
+# ANSI sequences to turn on every combination of attributes, indexed by a
+# bitmask of the attributes, in the order they appear in a pyte Char:
+# bold, italics, underscore, strikethrough, reverse. See _fx_flags().
+_FX_SEQUENCES = (_FX_BOLD, _FX_ITALIC, _FX_UNDERLINE, _FX_CROSSED_OUT,
+                 _FX_INVERSE)
+_FX_TABLE = tuple("".join(seq for bit, seq in enumerate(_FX_SEQUENCES)
+                          if mask & (1 << bit))
+                  for mask in range(1 << len(_FX_SEQUENCES)))
+
+# SGR codes for named fg/bg colors, indexed by pyte color name.
+#
+# Build them by inverting the tables pyte itself uses to parse SGR codes
+# into color names, so we emit exactly the code Vim asked for. This also
+# covers names like "brightbrown", for which the ansi package would emit
+# bold + brown instead of a bright color, and pyte's own misspelling of
+# bright magenta background.
+_FG_CODES = {name: code for code, name in
+             list(pyte.graphics.FG_ANSI.items()) +
+             list(pyte.graphics.FG_AIXTERM.items())}
+_BG_CODES = {name: code for code, name in
+             list(pyte.graphics.BG_ANSI.items()) +
+             list(pyte.graphics.BG_AIXTERM.items())}
+
+# SGR codes to set a truecolor fg/bg color.
+_FG_TRUECOLOR = 38
+_BG_TRUECOLOR = 48
+
+# ANSI sequences to set fg/bg colors, indexed by pyte color,
+# see _color_sequence().
+_FG_CACHE = {}
+_BG_CACHE = {}
+
+
+def _color_sequence(color, codes, truecolor, cache):
+    """Return the ANSI sequence to set a pyte color.
+
+    pyte represents a color either by name, e.g., "red", or as a hex RGB
+    string, e.g., "ff8000". Resolve it to an ANSI sequence via codes,
+    if it is a named color, or as a truecolor sequence otherwise, and
+    remember the result in cache: There are only a few distinct colors
+    in any file, but many thousands of characters.
+
+    """
+    seq = cache.get(color)
+    if seq is None:
+        code = codes.get(color)
+        if code is not None:
+            seq = "\x1b[%dm" % code
+        else:
+            seq = "\x1b[%d;2;%d;%d;%dm" % (truecolor,
+                                            int(color[0:2], 16),
+                                            int(color[2:4], 16),
+                                            int(color[4:6], 16))
+        cache[color] = seq
+    return seq
+
+
+# The style of a pyte Char is everything but its data:
+# (fg, bg, bold, italics, underscore, strikethrough, reverse).
+# We don't support blink, so leave it out.
+#
+# This is the style of our output right after _FX_RESET.
+_DEFAULT_STYLE = ("default", "default", False, False, False, False, False)
+
+# ANSI sequences to switch between styles, indexed by (prev, style),
+# see _style_sequence(). A file only uses a few styles, and only a few
+# of the transitions between them.
+_STYLE_SEQUENCES = {}
+
 
+def _fx_flags(style):
+    """Return the attributes of a style as a bitmask, to index _FX_TABLE."""
+    return (style[2] | style[3] << 1 | style[4] << 2 | style[5] << 3 |
+            style[6] << 4)
 
-def _dump_char_full(fh, char):
-    """Dump a single pyte Char will all its attributes.
 
-    Produce all necessary ANSI sequences to dump a pyte Char
-    with all its attributes to the writeable file-like object fh.
+def _style_sequence(prev, style):
+    """Return the ANSI sequences to switch from style prev to style.
+
+    Produce only the ANSI sequences needed for the change, or all of them,
+    if prev is None, because the current style of the output is unknown.
 
     """
-    # TODO: Optimize this, only output ANSI escape sequences for diffs
     # NOTE: This actually works with less -R! But it *has* to be -R,
     #       not -r, so less can keep track of where the cursor is,
     #       and search also works perfectly in this case.
     msg = []
-    # Moving it at the start, because this actually
-    # destroys fg/bg colors as well.
-    msg.append(fx.reset)
-    try:
-        msg.append(getattr(fg, char.fg))
-    except AttributeError:
-        msg.append(fg.truecolor(int(char.fg[0:2], 16),
-                                int(char.fg[2:4], 16),
-                                int(char.fg[4:6], 16)))
-    try:
-        msg.append(getattr(bg, char.bg))
-    except AttributeError:
-        msg.append(bg.truecolor(int(char.bg[0:2], 16),
-                                int(char.bg[2:4], 16),
-                                int(char.bg[4:6], 16)))
-    msg.append(fx.bold) if char.bold else None
-    msg.append(fx.italic) if char.italics else None
-    msg.append(fx.underline) if char.underscore else None
-    msg.append(fx.crossed_out) if char.strikethrough else None
-    msg.append(fx.reverse) if char.reverse else None
-    msg.append(char.data)
-    fh.write("".join([str(x) for x in msg]))
+    flags = _fx_flags(style)
+    prev_flags = 0 if prev is None else _fx_flags(prev)
+    # There is no single sequence to turn off an individual attribute,
+    # so start over if any attribute has to be turned off.
+    # Resetting actually destroys fg/bg colors as well.
+    if prev is None or prev_flags & ~flags:
+        msg.append(_FX_RESET)
+        prev = _DEFAULT_STYLE
+        prev_flags = 0
+    if style[0] != prev[0]:
+        msg.append(_color_sequence(style[0], _FG_CODES, _FG_TRUECOLOR,
+                                   _FG_CACHE))
+    if style[1] != prev[1]:
+        msg.append(_color_sequence(style[1], _BG_CODES, _BG_TRUECOLOR,
+                                   _BG_CACHE))
+    # Turn on any attributes which were off.
+    msg.append(_FX_TABLE[flags & ~prev_flags])
+    return "".join(msg)
 
 
 def dump_screen(screen, row_start, row_end):
     """Dump specific screen lines, including their attributes."""
 
-    # TODO: Actually dump the attributes of each character as well.
-
     # Inspect the attribute of each Char in the emulated terminal
     # and emit the necessary ANSI sequence to set it.
     #
@@ -196,35 +300,110 @@ def dump_screen(screen, row_start, row_end):
     #
     #     https://github.com/selectel/pyte/blob/master/pyte/screens.py#L70
     #
-    # See here for ansi-supported attributes:
+    # See here for the SGR sequences we emit for them:
     #
-    #     https://github.com/tehmaze/ansi/blob/master/ansi/colour/fx.py
-
-    # TODO: Do we really need sorted(list(...))?
-
-    for rowidx, row in sorted(list(screen.buffer.items()))[row_start:row_end]:
-        curidx = 0
-        for charidx, char in row.items():
-            # row is a sparse line.
-            # So fill in any gaps with the default char,
-            # until we actually reach charidx.
-            for curidx in range(curidx, charidx):
-                _dump_char_full(sys.stdout, screen.default_char)
-            curidx = charidx
-            _dump_char_full(sys.stdout, char)
-            curidx += 1
-        # Emit a newline if not at the actual end of the line
-        if curidx != screen.columns - 1:
-            # But make sure not to carry over any active attributes
-            sys.stdout.write(fx.reset + "\n")
-        sys.stdout.flush()
+    #     https://en.wikipedia.org/wiki/ANSI_escape_code#SGR
 
-    # sys.stdout.write(("\n".join(row.rstrip()
-    #                   for row in screen.display[row_start:row_end])) + "\n")
+    # Look up the rows we need directly, instead of sorting all rows in the
+    # screen buffer on every call. The buffer is sparse, and rows Vim has
+    # not touched are missing: use .get(), so we don't allocate them,
+    # and dump them as empty lines.
+    #
+    # Vim reports the line number of the last line in the file, which may
+    # be past the bottom of the screen, if the file is longer than
+    # MAX_LINES. Never dump rows which don't exist.
+    #
+    # Render everything into a list of strings, and write it out in one go,
+    # instead of going through sys.stdout, and flushing it, for every
+    # single character and line.
+    #
+    # This is the hot path, and it is CPU-bound, not I/O-bound: We only
+    # write once, at the end, but run the loop below in the interpreter
+    # for every single cell of the screen, tens of thousands of them for a
+    # long file. So keep all per-cell work in a single loop body, without
+    # function calls, and bind everything it needs to locals once, instead
+    # of looking up globals and attributes for every row and character.
+    #
+    # For most cells this is one slice, one comparison, and one append:
+    # Syntax highlighting produces long runs of characters with the same
+    # style, e.g., a whole keyword or comment, and we only emit ANSI
+    # sequences when the style changes. Even then, there are only a few
+    # distinct transitions between styles in any file, so look them up in
+    # _STYLE_SEQUENCES, and only compute them the first time we see them.
+    parts = []
+    append = parts.append
+    buffer_get = screen.buffer.get
+    default_style = screen.default_char[1:8]
+    default_data = screen.default_char.data
+    sequences = _STYLE_SEQUENCES
+    sequences_get = sequences.get
+    # Make sure not to carry over any active attributes to the next line.
+    newline = _FX_RESET + "\n"
+    # We don't know the style of the output when we start,
+    # so the first character sets it in full.
+    style = None
+    for rowidx in range(row_start, min(row_end, screen.lines)):
+        row = buffer_get(rowidx, {})
+        # pyte keeps the cells of a row in the order they were written,
+        # not in column order, e.g., if Vim moves the cursor back and
+        # redraws part of the line. Rows are almost always in order, so
+        # don't sort every one of them: Only if we run into a column out of
+        # order, throw away what we have produced for the row so far,
+        # and start over from its sorted cells.
+        items = row.items()
+        row_mark = len(parts)
+        row_style = style
+        while True:
+            curidx = 0
+            for charidx, char in items:
+                if charidx != curidx:
+                    if charidx < curidx:
+                        break
+                    # row is a sparse line.
+                    # So fill in any gaps with the default char,
+                    # until we actually reach charidx.
+                    # Switch to its style once, then emit the whole gap
+                    # at once.
+                    if style != default_style:
+                        key = (style, default_style)
+                        seq = sequences_get(key)
+                        if seq is None:
+                            seq = sequences[key] = _style_sequence(*key)
+                        append(seq)
+                        style = default_style
+                    append(default_data * (charidx - curidx))
+                char_style = char[1:8]
+                if char_style != style:
+                    key = (style, char_style)
+                    seq = sequences_get(key)
+                    if seq is None:
+                        seq = sequences[key] = _style_sequence(*key)
+                    append(seq)
+                    style = char_style
+                append(char.data)
+                curidx = charidx + 1
+            else:
+                break
+            del parts[row_mark:]
+            style = row_style
+            items = sorted(items)
+        # Always end the line, even if it fills the whole width:
+        # Terminals defer wrapping until the next character is printed,
+        # so this doesn't produce an empty line.
+        # Only reset attributes if there are any to reset, e.g.,
+        # not for empty lines, or lines without any highlighting.
+        append("\n" if style == _DEFAULT_STYLE else newline)
+        style = _DEFAULT_STYLE
+
+    # pyte decoded Vim's output as UTF-8, so encode it back the same way,
+    # regardless of the encoding of sys.stdout, and bypass its text layer.
+    sys.stdout.flush()
+    sys.stdout.buffer.write("".join(parts).encode("utf-8", "replace"))
+    sys.stdout.buffer.flush()
 
 
 def set_window_title_cb(screen, title):
-    """Callback to monkey-patch into Screen.set_title()."""
+    """Callback for SyncatScreen.set_title()."""
     # We're passing the actual number of lines via the side channel,
     # extract it now.
     try:
@@ -239,12 +418,63 @@ def set_window_title_cb(screen, title):
     # performing a terminal reset. We have pyte invoke this cb multiple
     # times, detect and ignore them when they happen.
 
-    rowprev = getattr(screen, "syncat_cb_rowprev", 0)
+    # Only dump the rows we haven't dumped already. Every dump starts from
+    # an unknown output style, so there is no state to carry across dumps.
+    rowprev = screen.syncat_cb_rowprev
     if row > rowprev:
-        dump_screen(screen, 0, row)
+        dump_screen(screen, rowprev, row)
         screen.syncat_cb_rowprev = row
 
 
+class SyncatScreen(pyte.Screen):
+    """A pyte Screen which dumps itself when Vim sets the window title.
+
+    Override set_title(), so we can detect whenever Vim attempts to update
+    the window title, and dump the screen, see set_window_title_cb().
+
+    Also provide a fast path for drawing plain text.
+
+    Profiling shows most of the time spent feeding Vim's output to pyte is
+    not in parsing escape sequences, but in Screen.draw(), which handles
+    every character separately, and builds a new Char for it via
+    namedtuple._replace().
+
+    Vim draws the file one highlighted token at a time, so almost every call
+    is for a short run of printable ASCII characters that fits in the
+    current line. Write these directly into the screen buffer, and let pyte
+    handle everything else: wide, combining, and non-ASCII characters,
+    line wrapping, and insert mode.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The rows we have already dumped, see set_window_title_cb().
+        self.syncat_cb_rowprev = 0
+
+    def set_title(self, param):
+        set_window_title_cb(self, param)
+
+    def draw(self, data):
+        cursor = self.cursor
+        x = cursor.x
+        end = x + len(data)
+        text = data.translate(self.g1_charset if self.charset
+                              else self.g0_charset)
+        if (end > self.columns or not text.isascii() or
+                not text.isprintable() or pyte.modes.IRM in self.mode):
+            return super().draw(data)
+
+        # Every cell gets the current cursor attributes,
+        # only the actual character differs.
+        attrs = cursor.attrs[1:]
+        line = self.buffer[cursor.y]
+        for x, char in enumerate(text, x):
+            line[x] = tuple.__new__(pyte.screens.Char, (char,) + attrs)
+        cursor.x = end
+        self.dirty.add(cursor.y)
+
+
 def pty_fork(child_stdin_fd=None, child_stdout_fd=None, child_stderr_fd=None):
     """A pty.fork() equivalent which allows arbitrary redirection.
 
@@ -279,6 +509,76 @@ def pty_fork(child_stdin_fd=None, child_stdout_fd=None, child_stderr_fd=None):
         raise RuntimeError(msg)
 
 
+def estimate_screen_lines(ifname, cols):
+    """Estimate how many screen lines Vim needs to display a file.
+
+    Count the lines of the input file, taking into account that Vim wraps
+    lines longer than the window, and err on the side of overestimating:
+    Count bytes instead of characters, and expand tabs to 8 columns.
+    The result is never more than MAX_LINES.
+
+    Return MAX_LINES if the input is not a regular file, because we can't
+    read it without consuming it, or if we can't read it at all, and let Vim
+    deal with it.
+
+    """
+    try:
+        if not stat.S_ISREG(os.stat(ifname).st_mode):
+            return MAX_LINES
+        width = max(cols - SCREEN_GUTTER_COLUMNS, 1)
+        lines = 0
+        with open(ifname, "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\r\n").expandtabs()
+                lines += max(1, -(-len(line) // width))
+                if lines >= MAX_LINES:
+                    return MAX_LINES
+    except OSError:
+        return MAX_LINES
+
+    return min(lines + SCREEN_LINES_MARGIN, MAX_LINES)
+
+
+def cat_file(ifname, ofd):
+    """Copy a file to a file descriptor verbatim, like cat(1).
+
+    Use sendfile() so the kernel copies the data directly, without passing
+    it through userspace. Fall back to a plain copy loop if the kernel
+    refuses, e.g., when the output is not a socket on platforms other than
+    Linux, or when the input is not a regular file.
+
+    """
+    with open(ifname, "rb") as f:
+        ifd = f.fileno()
+        size = os.fstat(ifd).st_size
+        offset = 0
+        # Stop as soon as we have copied the whole file, instead of calling
+        # sendfile() once more to detect EOF: If the output is a pipe, and
+        # its reader has gone away, e.g., `syncat file | head`, that last
+        # call fails with EPIPE, even though we have nothing left to write.
+        #
+        # Let the copy loop below pick up anything past size, if the file
+        # grew, or reports no size at all, e.g., files under /proc.
+        # For a regular file, this only costs a single, empty read().
+        try:
+            while offset < size:
+                sent = os.sendfile(ofd, ifd, offset, 1 << 20)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK,
+                               errno.ESPIPE):
+                raise
+
+        # sendfile() doesn't move the file position, so resume from where
+        # it stopped, if it managed to copy anything at all.
+        if offset:
+            f.seek(offset)
+        with open(ofd, "wb", closefd=False) as out:
+            shutil.copyfileobj(f, out)
+
+
 def main():
     # TODO: Implement Syncat-specific command-line arguments,
     #       parse the command line and isolate them from the rest of the
@@ -287,6 +587,35 @@ def main():
     #       empty document], fail if argument is not a regular file.
     # TODO: Pass all command line arguments to Vim
     # TODO: Implement a verbose mode, set up Python logging
+    # TODO: Turn $SYNCAT_COLOR into a `--color=auto/always/never` option,
+    #       similarly to GNU ls, once we parse the command line.
+    color = os.environ.get("SYNCAT_COLOR", SYNCAT_COLOR_DEFAULT)
+    if color not in SYNCAT_COLOR_CHOICES:
+        sys.stderr.write("syncat: invalid $SYNCAT_COLOR: %s, expected one of"
+                         " %s\n" % (color, ", ".join(SYNCAT_COLOR_CHOICES)))
+        return 2
+
+    # If we don't need to highlight the input, behave exactly like cat,
+    # without ever starting Vim or emulating a terminal.
+    if color == "never" or (color == "auto" and not sys.stdout.isatty()):
+        sys.stdout.flush()
+        try:
+            cat_file(sys.argv[1], sys.stdout.fileno())
+        except BrokenPipeError:
+            # Our reader has gone away, e.g., we're piped into head(1).
+            # Exit quietly, like cat does, and point stdout to devnull, so
+            # Python doesn't fail again when flushing it on exit, see
+            # https://docs.python.org/3/library/signal.html#note-on-sigpipe
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            return 1
+        except OSError as e:
+            # The input is missing, unreadable, or a directory.
+            # Report it like cat does, instead of with a traceback.
+            sys.stderr.write("syncat: %s: %s\n" % (sys.argv[1], e.strerror))
+            return 1
+        return 0
+
     cmdline = construct_vim_cmdline(sys.argv[1])
 
     # We actually can't retrieve the size of the current terminal
@@ -303,11 +632,6 @@ def main():
     # If we fail to retrieve the terminal size from STDOUT_FILENO [default],
     # try with STDERR_FILENO. This can happen if we're part of a pipeline,
     # so our stdout no longer points to the terminal.
-    #
-    # TODO: Fall back to executing cat directly, if stdout is not a TTY,
-    #       so we can function as a drop-in replacement. Add an option
-    #       to enforce syntax highlighting, e.g., `--color=auto/always/never`,
-    #       similarly to GNU ls.
     try:
         cols, rows = os.get_terminal_size()
     except OSError as e:
@@ -318,6 +642,10 @@ def main():
         else:
             raise
 
+    # Vim redraws every line of its window, so make the PTY, and the
+    # emulated terminal, only as tall as the input needs.
+    lines = estimate_screen_lines(sys.argv[1], cols)
+
     # Fork a child process for Vim, have it use its own PTY
     # Redirect the child's stdin to our own, presumably a terminal
     # Redirect the child's stderr to our own, to expose any Vim diagnostics
@@ -326,6 +654,26 @@ def main():
     # error independently, without racing with the child Vim
     # TODO: Confirm reading from a pipe works, redirect Vim's stdin accordingly
 
+    # Arrange to be notified when the child exits, so the main loop can wait
+    # on the PTY and on child exit in a single select().
+    #
+    # On Linux, use a pidfd, which becomes readable when the child exits.
+    # Otherwise, fall back to a self-pipe: Python writes to the wakeup fd
+    # whenever a signal arrives. Note SIGCHLD is ignored by default, so we
+    # need to install a handler, even a no-op one, for the wakeup fd to fire.
+    #
+    # We can only tell whether pidfds actually work once we have a child:
+    # os.pidfd_open() may exist, but fail with ENOSYS on kernels older than
+    # 5.3, or with EPERM under some seccomp profiles. So always set up the
+    # self-pipe, before forking, so we can't miss SIGCHLD if Vim exits early,
+    # and only use it if we fail to get a pidfd.
+    sigrfd, sigwfd = os.pipe()
+    os.set_blocking(sigrfd, False)
+    os.set_blocking(sigwfd, False)
+    old_sigchld_handler = signal.signal(signal.SIGCHLD,
+                                        lambda signum, frame: None)
+    old_wakeup_fd = signal.set_wakeup_fd(sigwfd)
+
     # TODO: Later on:
     # child_stdin_fd=sys.stdin.fileno()
     # child_stderr_fd=sys.stderr.fileno())
@@ -339,10 +687,9 @@ def main():
 
         # We already know the values for rows, cols.
         # We want our PTY to have the same number of columns as our original
-        # terminal, but a huge number of rows.
-        rows = MAX_LINES
-        pty_set_winsize(sys.stdout.fileno(), rows, cols)
-        terminal_set_size(sys.stdout.fileno(), rows, cols)
+        # terminal, but enough rows to fit the whole input.
+        pty_set_winsize(sys.stdout.fileno(), lines, cols)
+        terminal_set_size(sys.stdout.fileno(), lines, cols)
 
         # Configure the environment, and replace ourselves with Vim.
         # Useful for debugging our terminal state:
@@ -358,64 +705,129 @@ def main():
     # Parent process:
     # We know the PID of the child,
     # and the file descriptor for the new PTY.
+    try:
+        childfd = os.pidfd_open(pid)
+        use_pidfd = True
+    except (AttributeError, OSError):
+        childfd = sigrfd
+        use_pidfd = False
 
     # Allocate a new in-memory emulated terminal, and initialize it.
     # Use a ByteStream to feed it raw bytes, as retrieved from the kernel.
-    screen = pyte.Screen(cols, MAX_LINES)
-    stream = pyte.ByteStream(screen)
-
-    # Monkey patch the set_title() method, so we can detect
-    # whenever Vim attempts to update the window title,
-    # and dump the screen.
-    # See here for why we're using types.MethodType:
-    #
-    #      https://tryolabs.com/blog/2013/07/05/run-time-method-patching-python
     #
-    screen.set_title = types.MethodType(set_window_title_cb, screen)
+    # Note that allocating a tall screen is cheap: Since 0.8.0, pyte's screen
+    # buffer is sparse, rows and cells are only allocated when touched.
+    # We can't start with a smaller screen and grow it on demand, because
+    # Vim lays out its output according to the PTY size, which must match
+    # the size of the emulated terminal.
+    screen = SyncatScreen(cols, lines)
+    stream = pyte.ByteStream(screen)
 
-    # TODO: Test performance with byte arrays / memoryviews?
-    # buf = byterray(1000)
-    # mv = memoryview(buf)
+    # Retrieve data from the PTY into a single, preallocated buffer,
+    # so we don't allocate a new bytes object on every read().
+    # Use a raw, unbuffered file object over the PTY, which doesn't own
+    # the file descriptor, so we can use readinto().
+    # The PTY is non-blocking, so we can drain it completely every time
+    # select() reports it as readable; readinto() returns None when there
+    # is no more data available.
+    buf = bytearray(READ_SIZE)
+    mv = memoryview(buf)
+    os.set_blocking(ptyfd, False)
+    ptyfile = io.FileIO(ptyfd, "rb", closefd=False)
+
+    sel = selectors.DefaultSelector()
+    sel.register(ptyfd, selectors.EVENT_READ)
+    sel.register(childfd, selectors.EVENT_READ)
 
     # Main loop:
-    # Ensure the child is still alive,
-    # retrieve the bytes it sends to the PTY,
+    # Wait until either the PTY has data for us, or the child has exited.
+    # Retrieve the bytes the child sends to the PTY,
     # and feed them to the emulated terminal.
+    # Only call waitpid() once we know the child has exited.
+    #
+    # Considered approach:
+    # Queue PTY reads via io_uring, to amortize kernel entry/exit. We don't,
+    # because reads from a single PTY strictly serialize, every wakeup
+    # already drains up to READ_SIZE bytes per syscall, and the time spent
+    # in the kernel is negligible compared to parsing in pyte. It would also
+    # add a Linux-only, compiled dependency.
+    #
+    # Considered approach:
+    # Read from the PTY in a background thread, and parse in the main thread.
+    # This buys very little, because parsing holds the GIL, and we drain the
+    # PTY completely on every wakeup, so Vim is never blocked on us for long.
+    # It would also complicate tracking EIO and child exit.
     child_alive = True
     pty_eio = False
     while child_alive or not pty_eio:
-        if child_alive:
-            wpid, wstatus = os.waitpid(pid, os.WNOHANG)
-            if wpid > 0:
-                if wpid != pid:
-                    msg = ("Internal Error: waitpid() returned for unexpected"
-                           " PID %d != %d" % (wpid, pid))
-                    raise RuntimeError(msg)
-                # TODO:
-                # Only in Python 3.9:
-                # sys.exit(os.waitstatus_to_exitcode(wstatus))
-                # sys.stderr.write("Child exited. PID: %d, status: %d\n" %
-                #                  (wpid, wstatus))
-                # We know the child is dead,
-                # no need to call os.waitpid() for it anymore.
-                child_alive = False
-
-        # If someone is still using the slave end of the PTY, retrieve data.
-        if not pty_eio:
-            try:
-                buf = os.read(ptyfd, 1024)
-            except OSError as e:
-                if e.errno == errno.EIO:
-                    # This is expected: When the slave end of a PTY has closed,
-                    # reading the master end fails with -EIO.
-                    # In this case, our work here is done.
-                    pty_eio = True
-                else:
-                    raise
-
-            # We have received some bytes from the PTY,
-            # feed them to the emulated terminal, so it can update its state.
-            stream.feed(buf)
+        for key, events in sel.select():
+            if key.fd == childfd:
+                if not use_pidfd:
+                    # Drain the self-pipe, we don't care about its contents.
+                    while True:
+                        try:
+                            if not os.read(sigrfd, 512):
+                                break
+                        except BlockingIOError:
+                            break
+
+                # A pidfd only becomes readable when the child exits,
+                # but SIGCHLD is also sent when it stops, so don't block.
+                wpid, wstatus = os.waitpid(pid, os.WNOHANG)
+                if wpid > 0:
+                    if wpid != pid:
+                        msg = ("Internal Error: waitpid() returned for"
+                               " unexpected PID %d != %d" % (wpid, pid))
+                        raise RuntimeError(msg)
+                    # TODO:
+                    # Only in Python 3.9:
+                    # sys.exit(os.waitstatus_to_exitcode(wstatus))
+                    # sys.stderr.write("Child exited. PID: %d, status: %d\n" %
+                    #                  (wpid, wstatus))
+                    # We know the child is dead,
+                    # no need to call os.waitpid() for it anymore.
+                    child_alive = False
+                    sel.unregister(childfd)
+
+            if key.fd == ptyfd:
+                # Someone is still using the slave end of the PTY,
+                # retrieve all available data.
+                while True:
+                    try:
+                        n = ptyfile.readinto(mv)
+                    except OSError as e:
+                        if e.errno == errno.EIO:
+                            # This is expected: When the slave end of a PTY
+                            # has closed, reading the master end fails with
+                            # -EIO. In this case, our work here is done.
+                            pty_eio = True
+                            sel.unregister(ptyfd)
+                            break
+                        else:
+                            raise
+                    if n is None:
+                        # No more data for now, wait for the next event.
+                        break
+                    if n == 0:
+                        # Some platforms report EOF instead of -EIO.
+                        pty_eio = True
+                        sel.unregister(ptyfd)
+                        break
+
+                    # We have received some bytes from the PTY,
+                    # feed them to the emulated terminal, so it can update
+                    # its state. The UTF-8 decoder in pyte's ByteStream
+                    # accepts any bytes-like object, so there's no need to
+                    # copy the data out of the buffer.
+                    stream.feed(mv[:n])
+
+    sel.close()
+    if use_pidfd:
+        os.close(childfd)
+    signal.set_wakeup_fd(old_wakeup_fd)
+    signal.signal(signal.SIGCHLD, old_sigchld_handler)
+    os.close(sigrfd)
+    os.close(sigwfd)
 
     # Our work is done.
     # We must have already dumped the rendered file,
@@ -0,0 +1,166 @@
+# Copyright © 2023 Vangelis Koukis <vkoukis@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for Syncat."""
+
+import io
+import sys
+import random
+
+import pyte
+import pytest
+
+from syncat.syncat import SyncatScreen, dump_screen
+
+
+COLUMNS = 20
+LINES = 8
+
+
+def screen_state(screen):
+    """Return everything draw() may change in a screen, for comparison."""
+    buffer = {y: dict(line) for y, line in screen.buffer.items() if line}
+    cursor = (screen.cursor.x, screen.cursor.y, screen.cursor.attrs)
+    return buffer, cursor, screen.dirty
+
+
+def assert_same_as_pyte(data):
+    """Feed data to a SyncatScreen and a pyte Screen, and compare them."""
+    expected = pyte.Screen(COLUMNS, LINES)
+    actual = SyncatScreen(COLUMNS, LINES)
+    for screen in (expected, actual):
+        # A new screen starts with every line dirty, clear them,
+        # so we can tell which lines draw() marks as dirty.
+        screen.dirty.clear()
+        pyte.ByteStream(screen).feed(data)
+    assert screen_state(actual) == screen_state(expected)
+
+
+# SyncatScreen.draw() has a fast path for short runs of printable ASCII,
+# and falls back to pyte for everything else. Make sure both paths leave
+# the screen exactly as pyte would, so a pyte upgrade can't silently
+# break rendering.
+@pytest.mark.parametrize("data", [
+    # Plain ASCII, with colors and attributes
+    b"hello\x1b[1;31mworld\x1b[0m!",
+    b"\x1b[38;2;255;128;0mtrue\x1b[48;5;21mcolor\x1b[7mrev",
+    # Cursor movement, then overwrite existing text
+    b"abcdef\x1b[1;3Hxy\x1b[3;5Hz",
+    # Wide, combining, and non-ASCII characters
+    "a漢字b".encode("utf-8"),
+    "ééß".encode("utf-8"),
+    # Control characters mixed with text
+    b"a\tb\x08c\rd\ne",
+    # DEC special graphics charset, via G0 and via SO/SI on G1
+    b"\x1b(0lqqk\x1b(Bab",
+    b"\x1b)0a\x0elqk\x0fb",
+    # Insert mode
+    b"abcdef\x1b[1;3H\x1b[4hXY\x1b[4lZ",
+    # Wrapping, exactly filling the line, and with autowrap off
+    b"x" * COLUMNS + b"y",
+    b"x" * (COLUMNS - 2) + b"abcd",
+    b"\x1b[?7l" + b"x" * (COLUMNS + 5),
+])
+def test_draw_same_as_pyte(data):
+    assert_same_as_pyte(data)
+
+
+def test_draw_same_as_pyte_random():
+    pieces = [b"abc", b"hello world ", b"\t", b"\r\n", b"\x1b[1;31m",
+              b"\x1b[0m", b"\x1b[7m", b"\x1b[4h", b"\x1b[4l", b"\x1b(0",
+              b"\x1b(B", b"\x0e", b"\x0f", b"\x1b[?7l", b"\x1b[?7h",
+              b"\x1b[2;15H", b"\x1b[K", "漢".encode("utf-8"),
+              "é".encode("utf-8"), b"x" * COLUMNS]
+    rng = random.Random(0)
+    for _ in range(500):
+        assert_same_as_pyte(b"".join(rng.choices(pieces, k=20)))
+
+
+def capture_dump(monkeypatch, screen, row_start, row_end):
+    """Return the bytes dump_screen() writes to stdout."""
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+    monkeypatch.setattr(sys, "stdout", stdout)
+    dump_screen(screen, row_start, row_end)
+    return stdout.buffer.getvalue()
+
+
+def test_dump_stops_at_screen_bottom(monkeypatch):
+    # Vim reports the last line of the file, which may be past the bottom
+    # of the screen, for files longer than MAX_LINES.
+    screen = SyncatScreen(COLUMNS, LINES)
+    pyte.ByteStream(screen).feed(b"\r\n".join(b"x = %d" % i
+                                               for i in range(LINES)))
+    out = capture_dump(monkeypatch, screen, 0, screen.lines + 100)
+    assert out.count(b"\n") == screen.lines
+
+
+def assert_dump_same_as_screen(monkeypatch, screen, row_start, row_end):
+    """Dump screen, feed the result to pyte, and compare each cell."""
+    out = capture_dump(monkeypatch, screen, row_start, row_end)
+    rows = min(row_end, screen.lines) - row_start
+    # The dump ends every line with a bare "\n", which the terminal turns
+    # into "\r\n". Leave room for the newline after the last row, so pyte
+    # doesn't scroll the screen.
+    rendered = pyte.Screen(screen.columns, rows + 1)
+    pyte.ByteStream(rendered).feed(out.replace(b"\n", b"\r\n"))
+    for y in range(rows):
+        for x in range(screen.columns):
+            assert (rendered.buffer[y][x][:8] ==
+                    screen.buffer[row_start + y][x][:8]), (y, x)
+
+
+# SGR sequences to exercise every style we support: attributes on and off,
+# named, bright, 256 and truecolor fg/bg, and bright magenta background,
+# which pyte calls "bfightmagenta".
+DUMP_SGR = [b"0", b"1", b"3", b"4", b"9", b"7", b"22", b"23", b"24", b"27",
+            b"29", b"31", b"93", b"39", b"42", b"105", b"49", b"38;5;208",
+            b"48;5;21", b"38;2;255;128;0", b"48;2;16;32;48"]
+
+
+def random_screen(rng, columns, lines):
+    """Return a SyncatScreen with random, sparse, styled contents."""
+    screen = SyncatScreen(columns, lines)
+    stream = pyte.ByteStream(screen)
+    for y in range(lines):
+        # Leave some rows empty, so they are missing from the buffer.
+        if rng.random() < 0.2:
+            continue
+        for _ in range(rng.randint(1, 6)):
+            # Jump to a random column, to leave gaps in the row.
+            stream.feed(b"\x1b[%d;%dH" % (y + 1, rng.randint(1, columns)))
+            stream.feed(b"\x1b[%sm" % rng.choice(DUMP_SGR))
+            stream.feed(rng.choice([b"abc", b"x y", b"ab\x1b[1mcd", b"  "]))
+    return screen
+
+
+def test_dump_same_as_screen_random(monkeypatch):
+    rng = random.Random(0)
+    for _ in range(200):
+        screen = random_screen(rng, COLUMNS, LINES)
+        row_start = rng.randint(0, LINES - 1)
+        row_end = rng.randint(row_start + 1, LINES)
+        assert_dump_same_as_screen(monkeypatch, screen, row_start, row_end)
+
+
+# Terminals defer wrapping until the next character, so a line which fills
+# the whole width, and one just short of it, must both end with a newline.
+@pytest.mark.parametrize("width", [79, 80])
+def test_dump_same_as_screen_full_width(monkeypatch, width):
+    screen = SyncatScreen(80, LINES)
+    stream = pyte.ByteStream(screen)
+    for y in range(LINES):
+        stream.feed(b"\x1b[%d;1H\x1b[7m" % (y + 1) + b"x" * width)
+        stream.feed(b"\x1b[0m")
+    assert_dump_same_as_screen(monkeypatch, screen, 0, LINES)
+    assert_dump_same_as_screen(monkeypatch, screen, 2, LINES)